@@ -1,6 +1,7 @@
 """
 Script to turn raw data into features for modelling
 """
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import argparse
 import os
@@ -10,6 +11,7 @@ sys.path.append(ROOT_DIR)
 
 import pandas as pd
 
+from src.constants import parquet_write_options
 from src.preprocess.cancer_registry import get_demographic_data
 from src.preprocess.dart import get_symptoms_data
 from src.preprocess.lab import get_lab_data
@@ -19,9 +21,33 @@ from src.util import load_included_drugs, load_included_regimens
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--data-dir', type=str, default=f'{ROOT_DIR}/data')
+    parser.add_argument(
+        '--processes', 
+        type=int, 
+        default=1, 
+        help=('Number of datasets to build in parallel. By default they are built one at a time. Peak memory grows '
+              'roughly with the number of datasets held in memory at once')
+    )
     args = parser.parse_args()
     return args
 
+def save(df: pd.DataFrame, filepath: str):
+    df.to_parquet(filepath, index=False, **parquet_write_options)
+
+def build_and_save(get_data, filepath: str, *args, **kwargs):
+    """Build the dataset and save it from within the worker process, instead of sending the whole dataset back to the
+    main process just to be saved
+    """
+    save(get_data(*args, **kwargs), filepath)
+
+def build_and_save_symptoms_data(filepath: str, *args, **kwargs):
+    """Same as build_and_save, but only the (small) demographics from the symptom data are sent back, as they are 
+    required to build the demographics
+    """
+    symp, demog = get_symptoms_data(*args, **kwargs)
+    save(symp, filepath)
+    return demog
+
 def main():
     args = parse_args()
     data_dir = args.data_dir
@@ -30,23 +56,34 @@ def main():
     included_drugs = load_included_drugs(data_dir=f'{data_dir}/external')
     included_regimens = load_included_regimens(data_dir=f'{data_dir}/external')
     mrn_map = pd.read_csv(f'{data_dir}/external/MRN_map.csv')
-    mrn_map = mrn_map.set_index('RESEARCH_ID')['PATIENT_MRN'].to_dict()
-
-    # symptoms
-    dart, dart_demog = get_symptoms_data(data_dir=f'{data_dir}/raw')
-    dart.to_parquet(f'{data_dir}/interim/symptom.parquet.gzip', compression='gzip', index=False)
+    # keep the map as a Series (last entry wins for repeated research ids, same as building a dict)
+    mrn_map = mrn_map.drop_duplicates(subset='RESEARCH_ID', keep='last').set_index('RESEARCH_ID')['PATIENT_MRN']
 
-    # demographics
-    canc_reg = get_demographic_data(data_dir=f'{data_dir}/raw', external_data=dart_demog)
-    canc_reg.to_parquet(f'{data_dir}/interim/demographic.parquet.gzip', compression='gzip', index=False)
+    save_dir = f'{data_dir}/interim'
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        # the symptom, treatment, and laboratory test data are independent of each other, build them concurrently
+        dart_future = executor.submit(
+            build_and_save_symptoms_data, f'{save_dir}/symptom.parquet', data_dir=f'{data_dir}/raw'
+        )
+        futures = [
+            executor.submit(
+                build_and_save, get_treatment_data, f'{save_dir}/treatment.parquet', included_drugs, 
+                included_regimens, data_dir=f'{data_dir}/raw'
+            ),
+            executor.submit(
+                build_and_save, get_lab_data, f'{save_dir}/lab.parquet', mrn_map, data_dir=f'{data_dir}/raw'
+            )
+        ]
 
-    # treatment
-    opis = get_treatment_data(included_drugs, included_regimens, data_dir=f'{data_dir}/raw')
-    opis.to_parquet(f'{data_dir}/interim/treatment.parquet.gzip', compression='gzip', index=False)
+        # demographics (requires the demographics from the symptom data)
+        dart_demog = dart_future.result()
+        futures.append(executor.submit(
+            build_and_save, get_demographic_data, f'{save_dir}/demographic.parquet', data_dir=f'{data_dir}/raw', 
+            external_data=dart_demog
+        ))
 
-    # laboratory tests
-    lab = get_lab_data(mrn_map, data_dir=f'{data_dir}/raw')
-    lab.to_parquet(f'{data_dir}/interim/lab.parquet.gzip', compression='gzip', index=False)
+        # raise any errors from the workers
+        for future in futures: future.result()
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
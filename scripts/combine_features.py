@@ -62,10 +62,10 @@ def main():
     config_path = args.config_path
 
     if not os.path.exists(output_dir): os.makedirs(output_dir)
-    lab = pd.read_parquet(f'{data_dir}/interim/lab.parquet.gzip')
-    trt = pd.read_parquet(f'{data_dir}/interim/treatment.parquet.gzip')
-    dmg = pd.read_parquet(f'{data_dir}/interim/demographic.parquet.gzip')
-    sym = pd.read_parquet(f'{data_dir}/interim/symptom.parquet.gzip')
+    lab = pd.read_parquet(f'{data_dir}/interim/lab.parquet')
+    trt = pd.read_parquet(f'{data_dir}/interim/treatment.parquet')
+    dmg = pd.read_parquet(f'{data_dir}/interim/demographic.parquet')
+    sym = pd.read_parquet(f'{data_dir}/interim/symptom.parquet')
     included_drugs = load_included_drugs(data_dir=f'{data_dir}/external')
     with open(config_path) as file:
         cfg = yaml.safe_load(file)
@@ -10,10 +10,16 @@ patient_hematology_merged: 2.6GB -> 83MB
 from pathlib import Path
 import glob
 import os
+import sys
+ROOT_DIR = Path(__file__).parent.parent.as_posix()
+sys.path.append(ROOT_DIR)
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
 
-ROOT_DIR = Path(__file__).parent.parent.as_posix()
+from src.constants import parquet_write_options
 
 def main():
     data_root_dir = '/cluster/projects/gliugroup'
@@ -35,22 +41,30 @@ def main():
 
     mapping = {rad_file: 'radiology', biochem_file: 'biochemistry', hema_file: 'hematology'}
     for filepath, filename in mapping.items():
-        df = pd.read_csv(f'{filepath}.csv')
-        df = df.drop(columns=['Unnamed: 0'], errors='ignore')
-        if 'proc_code' in df.columns: df['proc_code'] = df['proc_code'].astype(str)
-        df.to_parquet(f'{save_dir}/{filename}.parquet.gzip', compression='gzip', index=False)
+        # NOTE: parse the large csv files with pyarrow's multithreaded csv reader and write the arrow table out 
+        # directly, instead of materializing python objects for every string cell with pandas
+        # NOTE: the whole file is read so the column types are inferred from all the rows (a streaming reader infers 
+        # them from the first block only, and fails on later blocks that do not match)
+        table = pv.read_csv(
+            f'{filepath}.csv', 
+            read_options=pv.ReadOptions(block_size=64 << 20),
+            convert_options=pv.ConvertOptions(column_types={'proc_code': pa.string()}, strings_can_be_null=True)
+        )
+        # drop the unnamed index column (pandas reads it as 'Unnamed: 0', pyarrow keeps the empty header)
+        table = table.drop([col for col in table.column_names if col in ['', 'Unnamed: 0']])
+        pq.write_table(table, f'{save_dir}/{filename}.parquet', **parquet_write_options)
 
     df = pd.read_excel(opis_file)
-    df.to_parquet(f'{save_dir}/opis.parquet.gzip', compression='gzip', index=False)
+    df.to_parquet(f'{save_dir}/opis.parquet', index=False, **parquet_write_options)
 
     df = pd.read_csv(dart_file)
     df = df.drop(columns=['Unnamed: 22'])
-    df.to_parquet(f'{save_dir}/dart.parquet.gzip', compression='gzip', index=False)
+    df.to_parquet(f'{save_dir}/dart.parquet', index=False, **parquet_write_options)
 
     df = pd.concat([pd.read_excel(filepath) for filepath in glob.glob(f'{canc_reg_dir}/*')])
     df['BRM_START'] = pd.to_datetime(df['BRM_START'], errors='coerce')
     df['INSURANCE_NUMBER'] = df['INSURANCE_NUMBER'].astype(str)
-    df.to_parquet(f'{save_dir}/cancer_registry.parquet.gzip', compression='gzip', index=False)
+    df.to_parquet(f'{save_dir}/cancer_registry.parquet', index=False, **parquet_write_options)
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
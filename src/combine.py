@@ -1,10 +1,9 @@
 """
 Module to combine features
 """
-from functools import partial
 from typing import Tuple
 
-from tqdm import tqdm
+import numpy as np
 import pandas as pd
 
 from .feat_eng import ( 
@@ -15,14 +14,15 @@ from .feat_eng import (
     get_years_diff, 
 )
 from .preprocess.opis import clean_drug_name
-from .util import get_excluded_numbers, split_and_parallelize
+from .util import get_excluded_numbers
 
 def combine_demographic_to_main_data(main: pd.DataFrame, demographic: pd.DataFrame, main_date_col: str):
     """
     Args:
         main_date_col: The column name of the main asessment date
     """
-    df = pd.merge(main, demographic, on='mrn', how='left')
+    # join against the mrn-indexed demographic table instead of a general merge on columns
+    df = main.join(demographic.set_index('mrn'), on='mrn').reset_index(drop=True)
 
     # exclude patients with missing birth date
     mask = df['date_of_birth'].notnull()
@@ -39,8 +39,8 @@ def combine_demographic_to_main_data(main: pd.DataFrame, demographic: pd.DataFra
     # date occured before treatment date
     cols = df.columns
     cols = cols[cols.str.contains('cancer_site|morphology')]
-    # TODO: find out why df[cols] = df[cols] < df[visit_date_col] is throwing errors
-    for col in cols: df[col] = df[col] < df[main_date_col]
+    # NOTE: comparing with the `<` operator aligns the series on the column names, compare row-wise instead
+    df[cols] = df[cols].lt(df[main_date_col], axis=0)
 
     return df
 
@@ -52,8 +52,7 @@ def combine_treatment_to_main_data(main: pd.DataFrame, treatment: pd.DataFrame,
     Args:
         main_date_col: The column name of the main asessment date
     """
-    cols = treatment.columns
-    drug_cols = cols[cols.str.startswith('drug_')].tolist()
+    drug_cols = [col for col in treatment.columns if col.startswith('drug_')]
     treatment_drugs = treatment[drug_cols + ['mrn', 'treatment_date']] # treatment drug dosage features
     treatment_feats = treatment.drop(columns=drug_cols) # other treatment features
     treatment_feats['trt_date'] = treatment_feats['treatment_date'] # include treatment date as a feature
@@ -69,18 +68,21 @@ def combine_perc_dose_to_main_data(main: pd.DataFrame, included_drugs: pd.DataFr
     NOTE: The given dose is already set ~2 days in advance prior to treatment date (i.e. no data leakage)
     """
     # create drug to dose formula map
-    included_drugs['name'] = [clean_drug_name(name)[0] for name in included_drugs['name']]
+    # NOTE: clean each unique drug name only once
+    drug_map = {drug: clean_drug_name(drug)[0] for drug in included_drugs['name'].unique()}
+    included_drugs['name'] = included_drugs['name'].map(drug_map)
     included_drugs = included_drugs.drop_duplicates()
     assert not any(included_drugs['name'].duplicated())
     drug_to_dose_formula_map = dict(included_drugs[['name', 'recommended_dose_formula']].to_numpy())
 
     # combine the percentage of ideal dose given features
     given_dose_over_ideal_dose = get_perc_ideal_dose_given(main, drug_to_dose_formula_map)
-    df = main.join(given_dose_over_ideal_dose)
+    given_dose_over_ideal_dose = given_dose_over_ideal_dose.astype(np.float32)
 
     # remove the raw dosage features
-    cols = df.columns
-    df = df.drop(columns=cols[cols.str.startswith('drug_')])
+    # NOTE: removed before the join so they are not copied into the joined result
+    drug_cols = [col for col in main.columns if col.startswith('drug_')]
+    df = main.drop(columns=drug_cols).join(given_dose_over_ideal_dose)
 
     return df
 
@@ -95,16 +97,16 @@ def combine_feat_to_main_data(
 
     Both main and feat should have mrn and date columns
     """
+    # NOTE: the extractor processes all the patients in a few sorted passes, no need to split up the data and ship 
+    # the partitions to worker processes
     mask = main['mrn'].isin(feat['mrn'])
-    worker = partial(extractor, main_date_col=main_date_col, feat_date_col=feat_date_col, **kwargs)
-    result = split_and_parallelize((main[mask], feat), worker)
-    cols = ['index'] + feat.columns.drop(['mrn', feat_date_col]).tolist()
-    result = pd.DataFrame(result, columns=cols).set_index('index')
+    result = extractor(main.loc[mask, ['mrn', main_date_col]], feat, main_date_col, feat_date_col, **kwargs)
     df = main.join(result)
     return df
 
 def extractor(
-    partition, 
+    main_df: pd.DataFrame,
+    feat_df: pd.DataFrame,
     main_date_col: str,
     feat_date_col: str,
     keep: str = 'last', 
@@ -113,6 +115,8 @@ def extractor(
     """Extract either the sum, first, or last forward filled feature measurements (lab tests, symptom scores, etc) 
     taken within the time window (centered on each main visit date)
 
+    NOTE: measurements taken on the same date are kept in their original order
+
     Args:
         main_date_col: The column name of the main visit date
         feat_date_col: The column name of the feature measurement date
@@ -122,40 +126,71 @@ def extractor(
     if keep not in ['first', 'last', 'sum']:
         raise ValueError('keep must be either first, last, or sum')
     
-    main_df, feat_df = partition
     lower_limit, upper_limit = time_window
     keep_cols = feat_df.columns.drop(['mrn', feat_date_col])
 
-    results = []
-    for mrn, main_group in tqdm(main_df.groupby('mrn')):
-        feat_group = feat_df.query('mrn == @mrn')
-
-        for idx, date in main_group[main_date_col].items():
-            earliest_date = date + pd.Timedelta(days=lower_limit)
-            latest_date = date + pd.Timedelta(days=upper_limit)
-
-            mask = feat_group[feat_date_col].between(earliest_date, latest_date)
-            if not mask.any(): 
-                continue
-
-            feats = feat_group.loc[mask, keep_cols]
-            if keep == 'sum':
-                result = feats.sum()
-            elif keep == 'first':
-                result = feats.iloc[0]
-            elif keep == 'last':
-                result = feats.ffill().iloc[-1]
-
-            results.append([idx]+result.tolist())
-    
-    return results
+    # order the measurements by patient and date, so the measurements within each time window are contiguous
+    # NOTE: measurements without a date or patient can never fall within a time window
+    mask = feat_df['mrn'].notnull() & feat_df[feat_date_col].notnull()
+    feat_df = feat_df[mask].sort_values(by=['mrn', feat_date_col]).reset_index(drop=True)
+    main_df = main_df[main_df[main_date_col].notnull()]
+
+    # encode each patient as an integer code (in the same order as the sorted measurements) and each date as its rank
+    # among all the measurement dates and window boundaries, so the measurements and window boundaries can all be
+    # located by a single sortable (patient, date) integer key
+    patients = pd.Index(feat_df['mrn'].unique())
+    feat_codes = patients.get_indexer(feat_df['mrn'])
+    main_codes = patients.get_indexer(main_df['mrn'])
+    earliest_date = main_df[main_date_col].to_numpy() + np.timedelta64(lower_limit, 'D')
+    latest_date = main_df[main_date_col].to_numpy() + np.timedelta64(upper_limit, 'D')
+    dates = np.concatenate([feat_df[feat_date_col].to_numpy(), earliest_date, latest_date])
+    unique_dates, date_ranks = np.unique(dates, return_inverse=True)
+    keys = np.concatenate([feat_codes, main_codes, main_codes]) * len(unique_dates) + date_ranks
+    feat_keys, earliest_keys, latest_keys = np.split(keys, [len(feat_df), len(feat_df) + len(main_df)])
+
+    # bracket the time window of every main visit with a binary search over the sorted measurement keys, instead of 
+    # scanning the patient's measurements for every visit
+    start = np.searchsorted(feat_keys, earliest_keys, side='left')
+    end = np.searchsorted(feat_keys, latest_keys, side='right')
+    # exclude visits without any measurements taken within the window
+    mask = (main_codes != -1) & (start < end)
+    if not mask.any():
+        return pd.DataFrame(columns=keep_cols)
+    index, start, end = main_df.index[mask], start[mask], end[mask]
+
+    feats = feat_df[keep_cols]
+    if keep == 'sum':
+        # NOTE: missing values are skipped in the sum. Sum all the windows at once with reduceat over the 
+        # (start, end) pairs, padding with an extra row of zeros so each end position is a valid index
+        values = feats.fillna(0).to_numpy()
+        values = np.concatenate([values, np.zeros_like(values[:1])])
+        result = np.add.reduceat(values, np.column_stack([start, end]).ravel(), axis=0)[::2]
+        result = pd.DataFrame(result, index=index, columns=keep_cols)
+    elif keep == 'first':
+        result = feats.iloc[start].set_axis(index)
+    elif keep == 'last':
+        # the last non-missing measurement of each feature taken within the window
+        # NOTE: equivalent to forward filling the measurements within the window and taking the last row
+        # 1. for every row, find the most recent row (up to and including itself) where each feature is not missing, in 
+        #    one cumulative pass over all the features
+        # 2. look it up at the last row of each window, and keep it if it was taken within the window
+        positions = np.where(feats.notnull().to_numpy(), np.arange(len(feats))[:, None], -1)
+        last_valid = np.maximum.accumulate(positions, axis=0)[end - 1]
+        result = {}
+        for i, col in enumerate(keep_cols):
+            mask = last_valid[:, i] >= start
+            result[col] = feats[col].iloc[last_valid[:, i]].set_axis(index)
+            if not mask.all(): 
+                result[col] = result[col].where(mask)
+        result = pd.DataFrame(result, index=index, columns=keep_cols)
+
+    return result
 
 def add_engineered_features(df, date_col: str = 'treatment_date'):
     df = get_visit_month_feature(df, col=date_col)
-    df['line_of_therapy'] = df.groupby('mrn', group_keys=False).apply(get_line_of_therapy)
+    df['line_of_therapy'] = get_line_of_therapy(df)
     df['days_since_starting_treatment'] = (df[date_col] - df['first_treatment_date']).dt.days
-    get_days_since_last_treatment = partial(
-        get_days_since_last_event, main_date_col=date_col, event_date_col='treatment_date'
+    df['days_since_last_treatment'] = get_days_since_last_event(
+        df, main_date_col=date_col, event_date_col='treatment_date'
     )
-    df['days_since_last_treatment'] = df.groupby('mrn', group_keys=False).apply(get_days_since_last_treatment)
     return df
\ No newline at end of file
@@ -207,4 +207,7 @@ obs_map = {
         'CA 19-9': 'carbohydrate_antigen_19-9',
         'LDH': 'lactate_dehydrogenase',
     }
-}
\ No newline at end of file
+}
+
+# parquet write options for the raw and interim datasets (pyarrow dictionary-encodes string columns by default)
+parquet_write_options = {'compression': 'zstd', 'compression_level': 3}
\ No newline at end of file
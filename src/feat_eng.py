@@ -1,7 +1,7 @@
 """
 Module for feature engineering
 """
-from typing import Dict
+from typing import Dict, List
 
 import numpy as np
 import pandas as pd
@@ -18,7 +18,9 @@ def get_visit_month_feature(df, col: str = 'treatment_date'):
 
 def get_days_since_last_event(df, main_date_col: str = 'treatment_date', event_date_col: str = 'treatment_date'):
     if main_date_col == event_date_col:
-        return (df[main_date_col] - df[event_date_col].shift()).dt.days
+        # shift within each patient's rows in one grouped pass
+        # NOTE: no need to sort the group keys, the result is aligned to the original rows
+        return (df[main_date_col] - df.groupby('mrn', sort=False)[event_date_col].shift()).dt.days
     else:
         return (df[main_date_col] - df[event_date_col]).dt.days
 
@@ -32,9 +34,10 @@ def get_line_of_therapy(df):
     # identify line of therapy (the nth different palliative intent treatment taken)
     # NOTE: all other intent treatment are given line of therapy of 0. Usually (not always but oh well) once the first
     # palliative treatment appears, the rest of the treatments remain palliative
-    new_regimen = (df['first_treatment_date'] != df['first_treatment_date'].shift())
+    # NOTE: shift and cumsum within each patient's rows in grouped passes, instead of calling this per patient
+    new_regimen = (df['first_treatment_date'] != df.groupby('mrn', sort=False)['first_treatment_date'].shift())
     palliative_intent = df['intent'] == 'PALLIATIVE'
-    return (new_regimen & palliative_intent).cumsum()
+    return (new_regimen & palliative_intent).groupby(df['mrn'], sort=False).cumsum()
 
 ###############################################################################
 # Drug dosages
@@ -44,33 +47,41 @@ def get_perc_ideal_dose_given(df, drug_to_dose_formula_map: Dict[str, str]):
 
     df must have weight, body surface area, age, female, and creatinine columns along with the dosage columns
     """
-    result = {}
-    for drug, dose_formula in drug_to_dose_formula_map.items():
-        dose_col = f'drug_{drug}_given_dose'
-        if dose_col not in df.columns: continue
-        ideal_dose = get_ideal_dose(df, drug, dose_formula)
-        perc_ideal_dose_given = df[dose_col] / ideal_dose
-        perc_ideal_dose_given = perc_ideal_dose_given.fillna(0)
-        result[drug] = perc_ideal_dose_given
-    result = pd.DataFrame(result)
+    drugs = [drug for drug in drug_to_dose_formula_map if f'drug_{drug}_given_dose' in df.columns]
+    given_dose = df[[f'drug_{drug}_given_dose' for drug in drugs]].to_numpy(dtype=float)
+
+    # compute the ideal doses of all the drugs sharing the same dose formula at once
+    ideal_dose = np.empty_like(given_dose)
+    dose_formulas = np.array([drug_to_dose_formula_map[drug] for drug in drugs], dtype=object)
+    for dose_formula in pd.unique(dose_formulas):
+        idxs = np.flatnonzero(dose_formulas == dose_formula)
+        ideal_dose[:, idxs] = get_ideal_dose(df, [drugs[idx] for idx in idxs], dose_formula)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        perc_ideal_dose_given = given_dose / ideal_dose
+    result = pd.DataFrame(perc_ideal_dose_given, index=df.index, columns=drugs).fillna(0)
     result.columns = '%_ideal_dose_given_' + result.columns
     return result
 
-def get_ideal_dose(df, drug: str, dose_formula: str):
-    col = f'drug_{drug}_regimen_dose'
+def get_ideal_dose(df, drugs: List[str], dose_formula: str) -> np.ndarray:
+    """Compute the ideal dose of each drug (column-wise), all following the same dose formula"""
+    cols = [f'drug_{drug}_regimen_dose' for drug in drugs]
+    regimen_dose = df[cols].to_numpy(dtype=float)
     carboplatin_dose_formula = ('min(regimen_dose * 150, regimen_dose * (((140-age[yrs]) * weight [kg] * 1.23 * '
                                 '(0.85 if female) / creatinine [umol/L]) + 25))')
     if dose_formula == 'regimen_dose': 
-        return df[col]
+        return regimen_dose
     
     elif dose_formula == 'regimen_dose * bsa': 
-        return df[col] * df['body_surface_area']
+        return regimen_dose * df['body_surface_area'].to_numpy(dtype=float)[:, None]
     
     elif dose_formula == 'regimen_dose * weight': 
-        return df[col] * df['weight']
+        return regimen_dose * df['weight'].to_numpy(dtype=float)[:, None]
     
     elif dose_formula == carboplatin_dose_formula:
-        return pd.concat([df[col] * 150, df[col] * (get_creatinine_clearance(df) + 25)], axis=1).min(axis=1)
+        creatinine_clearance = get_creatinine_clearance(df).to_numpy(dtype=float)[:, None]
+        # NOTE: fmin ignores missing values, same as taking the min across columns
+        return np.fmin(regimen_dose * 150, regimen_dose * (creatinine_clearance + 25))
     
     else:
         raise ValueError(f'Ideal dose formula {dose_formula} not supported')
@@ -79,4 +90,10 @@ def get_ideal_dose(df, drug: str, dose_formula: str):
 # Special Formulas
 ###############################################################################
 def get_creatinine_clearance(df):
-    return (140 - df['age']) * df['weight'] * 1.23 * df['female'].replace({True: 0.85, False: 1}) / df['creatinine']
\ No newline at end of file
+    # NOTE: computed directly on the underlying arrays, missing sex gives a missing sex factor
+    female = df['female']
+    female_factor = np.where(female.isnull(), np.nan, np.where(female.fillna(False).to_numpy(dtype=bool), 0.85, 1))
+    age, weight, creatinine = [df[col].to_numpy(dtype=float) for col in ['age', 'weight', 'creatinine']]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        creatinine_clearance = (140 - age) * weight * 1.23 * female_factor / creatinine
+    return pd.Series(creatinine_clearance, index=df.index)
\ No newline at end of file
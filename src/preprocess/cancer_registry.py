@@ -2,17 +2,33 @@
 Module to preprocess the cancer registry (cancer patient demographic data)
 """
 from typing import Optional
+
 import pandas as pd
+import pyarrow.parquet as pq
 
 from .. import ROOT_DIR, logger
 from ..constants import cancer_code_map
 from ..util import get_excluded_numbers
 
+cancer_registry_cols = [
+    'medical_record_number', 
+    'date_of_birth', 
+    'sex', 
+    'vital_status', 
+    'date_of_death', 
+    'diagnosis_date', 
+    'primary_site', 
+    'morphology'
+]
+
 def get_demographic_data(data_dir: Optional[str] = None, external_data: Optional[pd.DataFrame] = None):
     if data_dir is None:
         data_dir = f'{ROOT_DIR}/data/raw'
 
-    df = pd.read_parquet(f'{data_dir}/cancer_registry.parquet.gzip')
+    # only read the required columns
+    filepath = f'{data_dir}/cancer_registry.parquet'
+    cols = [col for col in pq.read_schema(filepath).names if col.lower() in cancer_registry_cols]
+    df = pd.read_parquet(filepath, columns=cols)
     df = filter_demographic_data(df)
     df = process_demographic_data(df)
     if external_data is not None:
@@ -24,36 +40,27 @@ def process_demographic_data(df):
     # order by diagnosis date
     df = df.sort_values(by='diagnosis_date')
 
+    # combine patients with mutliple diagnoses into one row
+    # handle conflicting data by taking the most recent entries
+    demog = df.groupby('mrn').agg({'date_of_birth': 'last', 'female': 'last'})
+
     # make each cancer site and morphology into a new column with diagnosis date as entry
-    cancer_site = df.pivot(columns='primary_site', values='diagnosis_date').loc[df.index]
-    morphology = df.pivot(columns='morphology', values='diagnosis_date').loc[df.index]
+    # if two diagnoses dates for same cancer site/morphology (e.g. first diagnoses in 2005, cancer returns in 2013) 
+    # take the first date (e.g. 2005)
+    cancer_site = df.groupby(['mrn', 'primary_site'])['diagnosis_date'].min().unstack()
+    morphology = df.groupby(['mrn', 'morphology'])['diagnosis_date'].min().unstack()
     cancer_site.columns = 'cancer_site_' + cancer_site.columns
     morphology.columns = 'morphology_' + morphology.columns
-    cancer = pd.concat([cancer_site, morphology], axis=1)
-    df = df.join(cancer)
-
-    # combine patients with mutliple diagnoses into one row
-    df = (
-        df
-        .groupby(['mrn'])
-        .agg({
-            # handle conflicting data by taking the most recent entries
-            'date_of_birth': 'last',
-            'female': 'last',
-            # if two diagnoses dates for same cancer site/morphology (e.g. first diagnoses in 2005, cancer returns in 
-            # 2013) take the first date (e.g. 2005)
-            **{col: 'min' for col in cancer.columns}
-        })
-    )
+    df = demog.join([cancer_site, morphology])
     df = df.reset_index()
 
     return df
     
 def filter_demographic_data(df):
     # clean column names
-    df.columns = df.columns.str.lower()
-    df.columns = df.columns.str.replace('start', 'start_date')
-    df = df.rename(columns= {'medical_record_number': 'mrn'})
+    col_map = {'medical_record_number': 'mrn'}
+    cols = [col.lower().replace('start', 'start_date') for col in df.columns]
+    df.columns = [col_map.get(col, col) for col in cols]
 
     # filter out patients without medical record numbers
     mask = df['mrn'].notnull()
@@ -65,7 +72,9 @@ def filter_demographic_data(df):
     df['morphology'] = df['morphology'].astype(int).astype(str)
 
     # sanity check - ensure vital status and death date matches and makes sense
-    mask = df['vital_status'].map({'Dead': False, 'Alive': True}) == df['date_of_death'].isnull()
+    # NOTE: compared directly instead of mapping the status to a boolean first
+    no_death_date = df['date_of_death'].isnull()
+    mask = ((df['vital_status'] == 'Alive') & no_death_date) | ((df['vital_status'] == 'Dead') & ~no_death_date)
     assert mask.all()
 
     # filter out patients whose sex is not Male/Female
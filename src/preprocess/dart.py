@@ -2,24 +2,35 @@
 Module to preprocess DART (symptom data)
 """
 from typing import Optional
+import re
+
 import pandas as pd
+import pyarrow.parquet as pq
 
 from .. import ROOT_DIR, logger
 from ..util import get_excluded_numbers
 
+dart_cols = ['mrn', 'date_of_birth', 'survey_date', 'research_consent', 'gender']
+
 def get_symptoms_data(data_dir: Optional[str] = None):
     if data_dir is None:
         data_dir = f'{ROOT_DIR}/data/raw'
 
-    df = pd.read_parquet(f'{data_dir}/dart.parquet.gzip')
+    # only read the required columns and the symptom score columns
+    filepath = f'{data_dir}/dart.parquet'
+    cols = [
+        col for col in pq.read_schema(filepath).names 
+        if col.lower() in dart_cols or re.search('esas_|_ecog', col.lower())
+    ]
+    df = pd.read_parquet(filepath, columns=cols)
     df = filter_symptoms_data(df)
     symp = process_symptoms_data(df)
     demog = df[['mrn', 'date_of_birth', 'female']].drop_duplicates()
     return symp, demog
 
 def process_symptoms_data(df):
-    # order by survey date
-    df = df.sort_values(by='survey_date')
+    # NOTE: no need to order by survey date beforehand, the group by below already sorts its keys and the mean does 
+    # not depend on row order
 
     # get columns of interest
     cols = df.columns
@@ -30,6 +41,7 @@ def process_symptoms_data(df):
         df
         .groupby(['mrn', 'survey_date'])
         .agg({col: 'mean' for col in cols}) # handle conflicting data by taking the mean
+        .astype('float32')
     )
     df = df.reset_index()
 
@@ -38,23 +50,25 @@ def process_symptoms_data(df):
 def filter_symptoms_data(df):
     # clean column names
     df.columns = df.columns.str.lower()
-    # clean data types
-    for col in ['date_of_birth', 'survey_date']: df[col] = pd.to_datetime(df[col])
     
     # filter out patients who consented out of research
-    df = df.query('research_consent != "N"')
+    df = df[df['research_consent'] != 'N']
 
     # filter out patients whose sex is not Male/Female
     mask = df['gender'] != 'Unknown'
     get_excluded_numbers(df, mask, context=' in which sex is Unknown')
-    df = df[mask].copy()
-    df['female'] = df.pop('gender') == 'Female'
+    df = df[mask]
 
     # exclude rows where symptoms scores are all missing
     cols = df.columns
     cols = cols[cols.str.contains('esas_|_ecog')]
     mask = df[cols].isnull().all(axis=1)
     get_excluded_numbers(df, ~mask, context=' without any symptom scores')
-    df = df[~mask]
+    # only copy once all the rows have been filtered out
+    df = df[~mask].copy()
+
+    df['female'] = df.pop('gender') == 'Female'
+    # clean data types
+    for col in ['date_of_birth', 'survey_date']: df[col] = pd.to_datetime(df[col])
 
     return df
@@ -1,31 +1,50 @@
 """
 Module to preprocess laboratory test data, which includes hematology and biochemistry data
 """
-from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Optional, Union
 
+import numpy as np
 import pandas as pd
 
 from .. import ROOT_DIR
 from ..constants import obs_map
 
-def get_lab_data(mrn_map: Dict[str, int], data_dir: Optional[str] = None):
+lab_col_map = {
+    # assign obs_ prefix to ensure no conflict with preexisting columns
+    'component-code-coding-0-display': 'obs_display',
+    'component-code-text': 'obs_text', 
+    'component-valueQuantity-unit': 'obs_unit',
+    'component-valueQuantity-value': 'obs_value',
+    'effectiveDateTime': 'effective_datetime',
+    'lastUpdated': 'updated_datetime',
+}
+
+def get_lab_data(mrn_map: Union[Dict[str, int], pd.Series], data_dir: Optional[str] = None):
     if data_dir is None:
         data_dir = f'{ROOT_DIR}/data/raw'
 
-    hema = pd.read_parquet(f'{data_dir}/hematology.parquet.gzip')
-    hema = filter_lab_data(hema, obs_name_map=obs_map['Hematology'])
-
-    biochem = pd.read_parquet(f'{data_dir}/biochemistry.parquet.gzip')
-    biochem = filter_lab_data(biochem, obs_name_map=obs_map['Biochemistry'])
+    # load and filter the hematology and biochemistry data concurrently (parquet decoding releases the GIL)
+    worker = partial(load_lab_data, data_dir=data_dir)
+    with ThreadPoolExecutor() as executor:
+        hema, biochem = executor.map(worker, ['Hematology', 'Biochemistry'])
 
     lab = pd.concat([hema, biochem])
     lab = process_lab_data(lab)
     lab['mrn'] = lab.pop('patientid').map(mrn_map) # map mrn to patientid
     return lab
 
+def load_lab_data(lab_type: str, data_dir: str):
+    cols = ['patientid'] + list(lab_col_map)
+    df = pd.read_parquet(f'{data_dir}/{lab_type.lower()}.parquet', columns=cols)
+    df = filter_lab_data(df, obs_name_map=obs_map[lab_type])
+    return df
+
 def process_lab_data(df):
     df['obs_datetime'] = pd.to_datetime(df['obs_datetime'], utc=True)
-    df['obs_date'] = pd.to_datetime(df['obs_datetime'].dt.date)
+    # truncate to the (UTC) date directly on the datetime64 values instead of roundtripping through python date objects
+    df['obs_date'] = df['obs_datetime'].dt.tz_convert(None).dt.normalize()
     df = df.sort_values(by='obs_datetime')
 
     # save the units for each observation name
@@ -33,12 +52,20 @@ def process_lab_data(df):
     # TODO: save unit map in feature store for later use
     print(unit_map)
 
-    # take the most recent value if multiple lab tests taken in the same day
-    # NOTE: dataframe already sorted by obs_datetime
-    df = df.groupby(['patientid', 'obs_date', 'obs_name']).agg({'obs_value': 'last'}).reset_index()
+    df['obs_name'] = df['obs_name'].astype('category')
 
-    # make each observation name into a new column
-    df = df.pivot(index=['patientid', 'obs_date'], columns='obs_name', values='obs_value').reset_index()
+    # take the most recent value if multiple lab tests taken in the same day, and make each observation name into a
+    # new column by unstacking the grouped result directly (avoids the intermediate frame built for pivot)
+    # NOTE: dataframe already sorted by obs_datetime
+    df = (
+        df
+        .groupby(['patientid', 'obs_date', 'obs_name'], observed=True)['obs_value']
+        .last()
+        .unstack('obs_name')
+        .sort_index(axis=1)
+    )
+    df.columns = df.columns.astype(str)
+    df = df.reset_index()
 
     df.columns.name = None
     return df
@@ -50,7 +77,10 @@ def filter_lab_data(df, obs_name_map: Optional[Dict] = None):
     df = df[df['obs_value'].notnull()]
 
     if obs_name_map is not None:
-        df['obs_name'] = df['obs_name'].map(obs_name_map)
+        # map the observation names
+        codes, uniques = pd.factorize(df['obs_name'])
+        obs_names = np.append(uniques.map(obs_name_map).to_numpy(dtype=object), np.nan) # code -1 -> missing name
+        df['obs_name'] = obs_names[codes]
         # exclude observations not in the name map
         df = df[df['obs_name'].notnull()]
 
@@ -74,35 +104,26 @@ def filter_units(df):
         'red_blood_cell': ['x10e6/L'],
         'white_blood_cell': ['x10e6/L'],
     }
-    mask = False
-    for obs_name, exclude_units in exclude_unit_map.items():
-        mask |= (df['obs_name'] == obs_name) & df['obs_unit'].isin(exclude_units)
+    # match the (name, unit) pairs in a single pass instead of building one mask per observation name
+    exclude_pairs = [(obs_name, unit) for obs_name, units in exclude_unit_map.items() for unit in units]
+    mask = pd.MultiIndex.from_frame(df[['obs_name', 'obs_unit']]).isin(exclude_pairs)
     df = df[~mask]
 
     return df
 
 def clean_lab_data(df):
     # clean column names
-    col_map = {
-        # assign obs_ prefix to ensure no conflict with preexisting columns
-        'component-code-coding-0-display': 'obs_display',
-        'component-code-text': 'obs_text', 
-        'component-valueQuantity-unit': 'obs_unit',
-        'component-valueQuantity-value': 'obs_value',
-        'effectiveDateTime': 'effective_datetime',
-        'lastUpdated': 'updated_datetime',
-    }
-    df = df.rename(columns=col_map)
+    df = df.rename(columns=lab_col_map)
 
     # the observation name is captured in two different columns, combine them together
     df['obs_name'] = df['obs_display'].fillna(df['obs_text'])
     # there are no cases where both display and text are filled
-    assert not any(df['obs_display'].notnull() & df['obs_text'].notnull())
+    assert not (df['obs_display'].notnull() & df['obs_text'].notnull()).any()
 
     # the datetime is captured in two different columns, combine them together
     df['obs_datetime'] = df['effective_datetime'].fillna(df['updated_datetime'])
     # effective datetime is always earlier (as in more accurate) than last updated datetime
-    mask = df['effective_datetime'].notnull()
-    assert all(df.loc[mask, 'effective_datetime'] < df.loc[mask, 'updated_datetime'])
+    # NOTE: checked in one vectorized pass over the full columns, without slicing out the rows with effective datetime
+    assert ((df['effective_datetime'] < df['updated_datetime']) | df['effective_datetime'].isnull()).all()
     
     return df
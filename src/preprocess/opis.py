@@ -18,7 +18,7 @@ def get_treatment_data(
     if data_dir is None:
         data_dir = f'{ROOT_DIR}/data/raw'
 
-    df = pd.read_parquet(f'{data_dir}/opis.parquet.gzip')
+    df = pd.read_parquet(f'{data_dir}/opis.parquet')
     df = filter_treatment_data(df, drugs, regimens)
     df = process_treatment_data(df)
     return df
@@ -30,25 +30,35 @@ def process_treatment_data(df) -> pd.DataFrame:
 
     # make each drug into two new columns (drug_given_dose, drug_regimen_dose), used to compute recommended ideal
     # dose and percentage of recommended ideal dose that was given
-    given_dose = df.pivot(columns='drug_name', values='given_dose').loc[df.index]
-    regimen_dose = df.pivot(columns='drug_name', values='regimen_dose').loc[df.index]
-    given_dose.columns = 'drug_' + given_dose.columns + '_given_dose'
-    regimen_dose.columns = 'drug_' + regimen_dose.columns + '_regimen_dose'
-    dosage = pd.concat([given_dose, regimen_dose], axis=1).fillna(0)
-    df = df.join(dosage)
+    # sum the dosages of the same drug given on the same day together
+    dosage = (
+        df
+        .groupby(['mrn', 'treatment_date', 'drug_name'])[['given_dose', 'regimen_dose']]
+        .sum()
+        .unstack('drug_name', fill_value=0)
+        .astype(float)
+    )
+    dosage.columns = [f'drug_{drug}_{dose_type}' for dose_type, drug in dosage.columns]
 
     # merge rows with same treatment days
     df = merge_same_day_treatments(df, dosage)
 
     # forward fill height and weight
-    for col in ['height', 'weight']: df[col] = df.groupby('mrn')[col].ffill()
+    # NOTE: the merged rows are sorted by mrn and treatment date, so each patient's rows are contiguous. Forward fill 
+    # all patients at once by carrying forward the position of the last non-missing value, restarting at each new 
+    # patient, instead of going through the patients group by group
+    new_patient = df['mrn'].ne(df['mrn'].shift()).to_numpy()
+    positions = np.arange(len(df))
+    for col in ['height', 'weight']:
+        values = df[col].to_numpy()
+        last_valid = np.maximum.accumulate(np.where(df[col].notnull().to_numpy() | new_patient, positions, 0))
+        df[col] = values[last_valid]
 
     return df
 
 
 def filter_treatment_data(df, drugs: pd.DataFrame, regimens: pd.DataFrame) -> pd.DataFrame:
     # clean column names
-    df.columns = df.columns.str.lower()
     col_map = {
         'hosp_chart': 'mrn', 
         'trt_date': 'treatment_date', 
@@ -56,7 +66,7 @@ def filter_treatment_data(df, drugs: pd.DataFrame, regimens: pd.DataFrame) -> pd
         'dose_ord': 'dose_ordered',
         'dose_given': 'given_dose'
     }
-    df = df.rename(columns=col_map)
+    df.columns = [col_map.get(col.lower(), col.lower()) for col in df.columns]
     
     # clean intent feature
     df['intent'] = df['intent'].replace('U', np.nan)
@@ -84,16 +94,18 @@ def filter_regimens(df, regimens: pd.DataFrame) -> pd.DataFrame:
 
     # group all clinical trials into TRIAL regimen
     mask = df['regimen'].str.startswith('CT-')
-    df.loc[mask, 'regimen'] = 'TRIAL'
+    df['regimen'] = np.where(mask, 'TRIAL', df['regimen'])
 
     # filter out rows not part of selected regimens
     mask = df['regimen'].isin(regimens['regimen'])
     get_excluded_numbers(df, mask, context=' not part of selected regimens')
-    df = df[mask].copy()
 
     # rename some of the regimens
-    regimen_map = dict(regimens.query('rename.notnull()')[['regimen', 'rename']].to_numpy())
-    df['regimen'] = df['regimen'].replace(regimen_map)
+    regimen_map = regimens.query('rename.notnull()').drop_duplicates(subset='regimen', keep='last')
+    regimen_map = regimen_map.set_index('regimen')['rename']
+    # NOTE: renamed before the mask is applied, so the frame is only copied once
+    df['regimen'] = df['regimen'].map(regimen_map).fillna(df['regimen'])
+    df = df[mask]
     return df
 
 
@@ -124,6 +136,71 @@ optional = lambda char: f'{char}?'
 either = lambda char1, char2: f'[{char1}|{char2}]'
 not_match = lambda exp: f'(?!{exp})' # negative lookahead
 
+# excess information to remove from the regimen and drug entries
+regimen_excess_substrs = [
+    'IND-NPC', # TODO: Ask what does it stand for?
+    'BS', # TODO: Ask what does it stand for?
+    'CCO', # Cancer Care Ontario
+    'SAP', # Special Access Program
+    'ADJ', # Adjuvant therapy
+    'CIV', # Continuous intravenous infusion
+    'FIXED',
+    'MVASI', # Biosimilar version of Bevacizumab
+    'NSCLC', # Non-small cell lung cancer,
+    'ELDERLY',
+    'BILIARY',
+    'PANCREAS',
+    'GASTRIC',
+    'ESOPHAGEAL',
+    'ANAL',
+    'THYMOMA'
+]
+drug_excess_substrs = [
+    '- PAID',
+    'SAP',
+    'SPECIAL ACCESS',
+    'STUDY',
+    'TRIAL',
+    'COMPASSIONATE',
+    'SUPPLY',
+    'SUPPL',
+    'SUP',
+    'MVASI', # Biosimilar version of bevacizumab
+    'AVASTIN', # Brand name for bevacizumab
+    'OGIVRI', # Brand name of biosimilar version of trastuzumab
+    'HERCEPTIN', # Brand name of trastuzumab
+    'ABRAXANE', # Brand name of paclitaxel
+    'ONIVYDE', # Brand name of irinotecan liposome injection
+    'HCL', # hydrochloride
+    'DISODIUM',
+    'TARTRATE',
+]
+# match any of the excess substrings at once, most entries contain none of them
+regimen_excess_regex = re.compile('|'.join(map(re.escape, regimen_excess_substrs)))
+drug_excess_regex = re.compile('|'.join(map(re.escape, drug_excess_substrs)))
+
+# dosing schedule / dosage information to remove from the regimen entries
+# NOTE: compiled once at import instead of rebuilding and looking up the pattern strings for every regimen
+regimen_schedule_patterns = [re.compile(pattern) for pattern in [
+    f'Q{any_digit}W', # e.g. Q2W
+    f'WX{any_digit}', # e.g. WX2
+    f'{any_digit}-W', # e.g. 2-W
+    f'{any_digit}X/W', # e.g. 2X/W
+    f'X{any_digit}{any_one_or_more_char}', # e.g. X6MON
+    f'{either("D", "C")}{any_digit},{any_one_or_more_digit},{any_one_or_more_digit}', # e.g. D1,8,15
+    f'D{any_digit},{any_one_or_more_digit}', # e.g. D1,15
+    f'D{any_digit}-{any_digit}', # e.g. D1-4
+    f'{either("D", "C")}{any_digit}', # e.g. C1
+    f'CYC {any_digit},{any_digit}', # e.g. CYC 1,2
+    f'{any_digit} DAY{optional("S")}', # e.g. 3 DAYS
+    f'{any_one_or_more_digit}MG/{any_char}{any_alphanumeric}' # e.g. 20MG/M2
+]]
+# shortened abbreviations to elongate in the regimen entries
+regimen_elongate_pattern_map = {
+    'CISP': re.compile(f'CIS{not_match("P")}'),
+    'PEME': re.compile(f'PEM{not_match("E|B")}'),
+}
+
 def clean_regimens(df) -> pd.DataFrame:
     df['original_regimen_entry'] = df['regimen'].copy()
 
@@ -221,45 +298,14 @@ def clean_regimen_name(regimen: str) -> Tuple[str, str]:
             
     # remove excess regimen information from the regimen entries
     note = ''
-    substrs = [
-        'IND-NPC', # TODO: Ask what does it stand for?
-        'BS', # TODO: Ask what does it stand for?
-        'CCO', # Cancer Care Ontario
-        'SAP', # Special Access Program
-        'ADJ', # Adjuvant therapy
-        'CIV', # Continuous intravenous infusion
-        'FIXED',
-        'MVASI', # Biosimilar version of Bevacizumab
-        'NSCLC', # Non-small cell lung cancer,
-        'ELDERLY',
-        'BILIARY',
-        'PANCREAS',
-        'GASTRIC',
-        'ESOPHAGEAL',
-        'ANAL',
-        'THYMOMA'
-    ]
-    for substr in substrs:
-        if substr in regimen:
-            regimen = regimen.replace(substr, '')
-            note += f'{substr}; '
+    if regimen_excess_regex.search(regimen):
+        for substr in regimen_excess_substrs:
+            if substr in regimen:
+                regimen = regimen.replace(substr, '')
+                note += f'{substr}; '
             
-    patterns = [
-        f'Q{any_digit}W', # e.g. Q2W
-        f'WX{any_digit}', # e.g. WX2
-        f'{any_digit}-W', # e.g. 2-W
-        f'{any_digit}X/W', # e.g. 2X/W
-        f'X{any_digit}{any_one_or_more_char}', # e.g. X6MON
-        f'{either("D", "C")}{any_digit},{any_one_or_more_digit},{any_one_or_more_digit}', # e.g. D1,8,15
-        f'D{any_digit},{any_one_or_more_digit}', # e.g. D1,15
-        f'D{any_digit}-{any_digit}', # e.g. D1-4
-        f'{either("D", "C")}{any_digit}', # e.g. C1
-        f'CYC {any_digit},{any_digit}', # e.g. CYC 1,2
-        f'{any_digit} DAY{optional("S")}', # e.g. 3 DAYS
-        f'{any_one_or_more_digit}MG/{any_char}{any_alphanumeric}' # e.g. 20MG/M2
-    ]
-    for pattern in patterns:
-        substrs = re.findall(pattern, regimen)
+    for pattern in regimen_schedule_patterns:
+        substrs = pattern.findall(regimen)
         if len(substrs) > 0:
             assert len(substrs) == 1
             substr = substrs[0]
@@ -271,17 +317,12 @@ def clean_regimen_name(regimen: str) -> Tuple[str, str]:
         note += f'Weekly; '
     
     # clean up punctuation marks
-    for chars in ['()', '/', ';', ' ']:
-        regimen = regimen.replace(chars, '') # remove empty brackets, slashes, semicolons, white spaces
+    regimen = re.sub(r'\(\)|[/; ]', '', regimen) # remove empty brackets, slashes, semicolons, white spaces in one pass
     regimen = regimen.rstrip('-(+') # remove trailing dash, open bracket, plus sign
     
     # elongate some of the shortened abbreviations to make entries consistent
-    pattern_map = {
-        'CISP': f'CIS{not_match("P")}',
-        'PEME': f'PEM{not_match("E|B")}',
-    }
-    for replacement, pattern in pattern_map.items():
-        regimen = re.sub(pattern, replacement, regimen)
+    for replacement, pattern in regimen_elongate_pattern_map.items():
+        regimen = pattern.sub(replacement, regimen)
     
     return regimen, note
 
@@ -291,30 +332,11 @@ def clean_drug_name(drug: str) -> Tuple[str, str]:
     
     # remove excess drug information from the drug entries
     note = ''
-    substrs = [
-        '- PAID',
-        'SAP',
-        'SPECIAL ACCESS',
-        'STUDY',
-        'TRIAL',
-        'COMPASSIONATE',
-        'SUPPLY',
-        'SUPPL',
-        'SUP',
-        'MVASI', # Biosimilar version of bevacizumab
-        'AVASTIN', # Brand name for bevacizumab
-        'OGIVRI', # Brand name of biosimilar version of trastuzumab
-        'HERCEPTIN', # Brand name of trastuzumab
-        'ABRAXANE', # Brand name of paclitaxel
-        'ONIVYDE', # Brand name of irinotecan liposome injection
-        'HCL', # hydrochloride
-        'DISODIUM',
-        'TARTRATE',
-    ]
-    for substr in substrs:
-        if substr in drug:
-            drug = drug.replace(substr, '')
-            note += f'{substr}; '
+    if drug_excess_regex.search(drug):
+        for substr in drug_excess_substrs:
+            if substr in drug:
+                drug = drug.replace(substr, '')
+                note += f'{substr}; '
             
     drug = drug.replace('PACLITAXEL', 'PACL')
             
@@ -332,15 +354,22 @@ def merge_same_day_treatments(df, dosage: pd.DataFrame):
     Collapse multiples rows with the same treatment day into one
 
     Essential for aggregating the different drugs administered on the same day
+
+    Args:
+        dosage: The summed drug dosages of each treatment day, indexed by mrn and treatment date
     """
-    format_regimens = lambda regs: ' && '.join(sorted(set(regs)))
+    # handle conflicting data by 
+    # 1. join them togehter (the unique regimens, in sorted order)
+    # NOTE: most treatment days only have one regimen, only the days with multiple regimens need to be joined
+    regimens = df[['mrn', 'treatment_date', 'regimen']].drop_duplicates().sort_values(by='regimen')
+    regimens = regimens.set_index(['mrn', 'treatment_date'])['regimen']
+    mask = regimens.index.duplicated(keep=False)
+    regimens = pd.concat([regimens[~mask], regimens[mask].groupby(level=['mrn', 'treatment_date']).agg(' && '.join)])
+
     df = (
         df
         .groupby(['mrn', 'treatment_date'])
         .agg({
-            # handle conflicting data by 
-            # 1. join them togehter
-            'regimen': format_regimens,
             # 2. take the mean 
             'height': 'mean',
             'weight': 'mean',
@@ -358,10 +387,10 @@ def merge_same_day_treatments(df, dosage: pd.DataFrame):
             # 'change_reason_desc': 'first', 
             # 'route': 'first', 
             # 'chemo_flag': 'first'
-
-            # sum the dosages together
-            **{col: 'sum' for col in dosage.columns}
         })
     )
+    df.insert(0, 'regimen', regimens)
+    # add the summed dosages
+    df = df.join(dosage)
     df = df.reset_index()
     return df
\ No newline at end of file
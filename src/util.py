@@ -25,7 +25,8 @@ def load_included_regimens(data_dir: Optional[str] = None) -> pd.DataFrame:
     if data_dir is None:
         data_dir = f'{ROOT_DIR}/data/external'
         
-    df = pd.read_csv(f'{data_dir}/opis_regimen_list.csv')
+    # only parse the columns used downstream
+    df = pd.read_csv(f'{data_dir}/opis_regimen_list.csv', usecols=lambda col: col.lower() in ['regimen', 'rename'])
     df.columns = df.columns.str.lower()
     return df
 
@@ -76,6 +77,6 @@ def get_nunique_categories(df: pd.DataFrame) -> pd.DataFrame:
 
 def get_excluded_numbers(df, mask: pd.Series, context: str = '.') -> None:
     """Report the number of patients and sessions that were excluded"""
-    N_sessions = sum(~mask)
-    N_patients = len(set(df['mrn']) - set(df.loc[mask, 'mrn']))
+    N_sessions = (~mask).sum()
+    N_patients = df['mrn'].nunique() - df.loc[mask, 'mrn'].nunique()
     logger.info(f'Removing {N_patients} patients and {N_sessions} sessions{context}')
\ No newline at end of file